@@ -1,110 +1,404 @@
 # api/usdb-search.py
+import io
 import json
+import logging
 import os
+import threading
+import time
 import traceback
-from io import BytesIO
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+import tempfile
 import zipfile
+import socket
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 
-def log(msg):
-    print(f"[USDB] {msg}")
+# Selector de filas de la tabla de resultados, compartido por ambos parsers
+ROW_SELECTOR = "table.songlist tr"
 
-def handler(event, context):
-    log("Función invocada")
-    log(f"Event: {json.dumps(event)[:500]}...")
+# selectolax (parser C) es ~5-20× más rápido que BS4 para extraer-y-listo;
+# si no está instalado caemos a BS4 con el backend lxml (también C)
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+    from bs4 import BeautifulSoup
+    import soupsieve
+    # Selector compilado una sola vez en vez de re-parsearlo por invocación
+    _row_selector = soupsieve.compile(ROW_SELECTOR)
+
+# orjson (Rust) serializa payloads unicode pesados 3-10× más rápido que el
+# json de la stdlib; si no está instalado seguimos con json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(s):
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def json_dumps(obj):
+    if orjson is not None:
+        # Vercel espera body str, no bytes
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+# Logger con nivel configurable por env var: en producción (WARNING) los
+# mensajes por fila ni siquiera formatean su string (formateo perezoso %s)
+logger = logging.getLogger("usdb")
+logger.setLevel(os.environ.get("USDB_LOG", "WARNING"))
+# Handler propio: sin él, todo lo que esté bajo WARNING muere en el
+# lastResort de logging y el nivel de USDB_LOG no tendría efecto. Lo
+# dejamos solo en este logger (sin basicConfig) para no activar de paso
+# el debug de urllib3 y compañía.
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("[USDB] %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+# Cache de resultados entre invocaciones (sobrevive mientras el contenedor
+# esté caliente): las búsquedas populares se repiten mucho y una respuesta
+# cacheada evita login + búsqueda + descargas completas
+CACHE_TTL = 3600
+CACHE_MAX = 512
+
+# Tope de tamaño de ZIP aceptado: por encima de esto ni lo descargamos
+MAX_ZIP_BYTES = 50_000_000
+_results_cache = {}  # query normalizada → (expira, body JSON)
+_cache_lock = threading.Lock()
+
+def cache_key(query):
+    return unicodedata.normalize("NFKC", query).casefold().strip()
+
+def cache_get(key):
+    with _cache_lock:
+        entry = _results_cache.get(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        if time.time() > expires:
+            del _results_cache[key]
+            return None
+        return body
+
+def cache_put(key, body):
+    with _cache_lock:
+        if len(_results_cache) >= CACHE_MAX:
+            # Descartamos la entrada más vieja para no crecer sin límite
+            oldest = min(_results_cache, key=lambda k: _results_cache[k][0])
+            del _results_cache[oldest]
+        _results_cache[key] = (time.time() + CACHE_TTL, body)
+
+# Sesión a nivel de módulo: en contenedores calientes el pool de urllib3
+# (y sus conexiones TLS ya establecidas) sobrevive entre invocaciones
+_session = requests.Session()
+_session.headers.update({
+    "User-Agent": "Mozilla/5.0 (compatible; karAIoke-bot)",
+    "Connection": "keep-alive",
+    # Comprimir el HTML de búsqueda ahorra bytes en el cable
+    "Accept-Encoding": "gzip, deflate",
+})
+# Todo (login + búsqueda + hasta 10 ZIPs) va contra usdb.eu: un pool
+# amplio evita rehacer el handshake TLS en cada request paralelo
+_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
+# Pre-resolvemos usdb.eu en el import: el arranque frío paga el lookup DNS
+# fuera del camino crítico del primer request (el resolver lo cachea)
+try:
+    socket.getaddrinfo("usdb.eu", 443, proto=socket.IPPROTO_TCP)
+except OSError:
+    pass
+
+# La cookie de sesión de USDB se persiste en /tmp (escribible en Vercel)
+# para saltarnos el POST de login en invocaciones calientes
+COOKIES_PATH = "/tmp/usdb_cookies.json"
+
+def load_cookies(session):
+    try:
+        with open(COOKIES_PATH) as f:
+            session.cookies.update(json.load(f))
+        return len(session.cookies) > 0
+    except (OSError, ValueError):
+        return False
+
+def save_cookies(session):
+    try:
+        with open(COOKIES_PATH, "w") as f:
+            json.dump(requests.utils.dict_from_cookiejar(session.cookies), f)
+    except OSError:
+        pass
+
+def do_login(session):
+    """Hace el POST de login contra USDB. Devuelve True si la sesión quedó autenticada."""
+    login_payload = {
+        "email": os.environ.get("USDB_EMAIL"),
+        "password": os.environ.get("USDB_PASS"),
+        "remember": "1"
+    }
+    logger.info("Intentando login...")
+    # Sin seguir redirects: el redirect a /dashboard ya confirma el login
+    # sin bajar ni escanear los KB de HTML de la página destino
+    login_resp = session.post("https://usdb.eu/login", data=login_payload,
+                              timeout=15, allow_redirects=False)
+    logger.info("Login status: %s | Location: %s",
+                login_resp.status_code, login_resp.headers.get("Location", ""))
+
+    ok = (login_resp.status_code in (301, 302, 303)
+          and "/dashboard" in login_resp.headers.get("Location", ""))
+    if not ok:
+        # Camino de error: recién acá seguimos el redirect y caemos al
+        # chequeo por contenido de siempre, por si USDB cambió el flujo
+        login_resp = session.post("https://usdb.eu/login", data=login_payload,
+                                  timeout=15, allow_redirects=True)
+        if "dashboard" not in login_resp.url and "logout" not in login_resp.text:
+            logger.warning("Login falló (credenciales malas o captcha)")
+            return False
+
+    logger.info("Login exitoso")
+    save_cookies(session)
+    return True
+
+def zip_headers(session):
+    """Headers planos (User-Agent + Cookie de sesión) para los GETs de ZIP vía urllib3."""
+    headers = {
+        "User-Agent": session.headers.get("User-Agent", ""),
+        # identity: el ZIP ya viene deflated; gzip encima solo quemaría CPU
+        # gunzipeando para cero ganancia de ratio
+        "Accept-Encoding": "identity",
+    }
+    cookies = requests.utils.dict_from_cookiejar(session.cookies)
+    if cookies:
+        headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+    return headers
+
+def download_zip(pool, url, headers):
+    """Descarga el ZIP en streaming a un buffer spooled (RAM hasta 1 MB, luego /tmp).
+
+    Va directo contra el PoolManager de urllib3 (el mismo pool que monta la
+    sesión) saltándose prepare_request/hooks de requests, que son puro
+    overhead por llamada en este loop de GETs idénticos.
+
+    Evita materializar la respuesta completa en un bytes: zipfile solo
+    necesita un file-like seekable para localizar el directorio central.
+    (Se evaluó stream-unzip, que descomprime miembro a miembro del stream,
+    pero el .txt suele venir después del MP3/video dentro del archivo y un
+    buffer seekable permite saltar directo a esa entrada sin descomprimir
+    lo anterior.) Devuelve el buffer listo para leer, o None si falló.
+    """
+    resp = pool.request("GET", url, headers=headers, timeout=20,
+                        preload_content=False)
+    try:
+        if resp.status != 200:
+            return None
+        buf = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        for chunk in resp.stream(64 * 1024):
+            buf.write(chunk)
+        buf.seek(0)
+        return buf
+    finally:
+        resp.release_conn()
 
+def parse_rows(html):
+    """Extrae (artist, title, href) de las primeras 10 filas de la tabla de resultados."""
+    candidates = []
+    if HTMLParser is not None:
+        tree = HTMLParser(html)
+        rows = tree.css(ROW_SELECTOR)[1:11]
+        for row in rows:
+            cols = row.css("td")
+            if len(cols) < 5:
+                continue
+            artist = cols[0].text(strip=True)
+            title  = cols[1].text(strip=True)
+            dl_link = row.css_first("td:last-child a")
+            if not dl_link:
+                continue
+            href = dl_link.attributes.get("href")
+            if not href:
+                continue
+            candidates.append((artist, title, href))
+    else:
+        soup = BeautifulSoup(html, "lxml")
+        # iselect + islice: recorremos solo las filas 1-10 sin materializar
+        # la lista completa de <tr> para después recortarla
+        rows = islice(_row_selector.iselect(soup), 1, 11)
+        for row in rows:
+            # limit=5: bs4 corta la búsqueda al quinto <td> en vez de
+            # recorrer y listar todas las celdas solo para contarlas
+            cols = row.find_all("td", limit=5)
+            if len(cols) < 5:
+                continue
+            artist = cols[0].get_text(strip=True)
+            title  = cols[1].get_text(strip=True)
+            # Última celda escaneando los hijos directos desde el final
+            last_td = next((c for c in reversed(row.contents)
+                            if getattr(c, "name", None) == "td"), None)
+            dl_link = last_td.find("a") if last_td is not None else None
+            if not dl_link:
+                continue
+            candidates.append((artist, title, dl_link["href"]))
+    return candidates
+
+def handler(event, context):
     if event.get("httpMethod") != "POST":
-        log("Error: método no permitido")
+        logger.info("Error: método no permitido")
         return {"statusCode": 405, "body": "Method Not Allowed"}
 
     try:
-        body = json.loads(event.get("body") or "{}")
+        body = json_loads(event.get("body") or "{}")
         query = body.get("query", "").strip()
         if not query:
-            log("Error: query vacío")
+            logger.info("Error: query vacío")
             return {"statusCode": 400, "body": json.dumps({"error": "Falta query"})}
 
-        log(f"Buscando: {query}")
+        logger.info("Buscando: %s", query)
 
-        session = requests.Session()
-        session.headers.update({"User-Agent": "Mozilla/5.0 (compatible; karAIoke-bot)"})
+        key = cache_key(query)
+        cached = cache_get(key)
+        if cached is not None:
+            logger.info("Cache HIT → respondemos sin tocar la red")
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "application/json", "X-Cache": "HIT"},
+                "body": cached
+            }
 
-        # LOGIN
-        login_url = "https://usdb.eu/login"
-        login_payload = {
-            "email": os.environ.get("USDB_EMAIL"),
-            "password": os.environ.get("USDB_PASS"),
-            "remember": "1"
-        }
-        log("Intentando login...")
-        login_resp = session.post(login_url, data=login_payload, timeout=15, allow_redirects=True)
-        log(f"Login status: {login_resp.status_code} | URL final: {login_resp.url}")
-
-        if "dashboard" not in login_resp.url and "logout" not in login_resp.text:
-            log("Login falló (credenciales malas o captcha)")
-            return {"statusCode": 401, "body": json.dumps({"error": "Login falló en USDB"})}
+        session = _session
 
-        log("Login exitoso")
+        # LOGIN: con cookie persistida nos saltamos el POST y vamos directo a buscar
+        if not load_cookies(session):
+            if not do_login(session):
+                return {"statusCode": 401, "body": json.dumps({"error": "Login falló en USDB"})}
 
         # BÚSQUEDA
         search_resp = session.get("https://usdb.eu/search", params={"q": query}, timeout=15)
-        log(f"Búsqueda status: {search_resp.status_code}")
-        soup = BeautifulSoup(search_resp.text, "html.parser")
-        rows = soup.select("table.songlist tr")[1:11]
-        log(f"Encontradas {len(rows)} filas")
+        logger.info("Búsqueda status: %s", search_resp.status_code)
 
+        # Cookie vencida → re-login y reintentamos la búsqueda una vez
+        if search_resp.status_code == 401 or "/login" in search_resp.url:
+            logger.info("Sesión expirada → re-login")
+            if not do_login(session):
+                return {"statusCode": 401, "body": json.dumps({"error": "Login falló en USDB"})}
+            search_resp = session.get("https://usdb.eu/search", params={"q": query}, timeout=15)
+            logger.info("Búsqueda status (reintento): %s", search_resp.status_code)
+        # Pre-extraemos los candidatos (artist, title, url) antes de tocar la red
+        candidates = [
+            (artist, title, urljoin("https://usdb.eu", href))
+            for artist, title, href in parse_rows(search_resp.text)
+        ]
+        logger.info("Encontradas %d filas válidas", len(candidates))
+
+        # Descargas en paralelo: la latencia pasa de suma-de-N a max-de-N RTTs.
+        # Se evaluó migrar a httpx.AsyncClient con HTTP/2: para 3-10 fetches
+        # I/O-bound el pool de hilos rinde igual, y mantener requests conserva
+        # el pool/cookies/Retry ya montados sin sumar una dependencia más.
         results = []
-        for i, row in enumerate(rows):
-            log(f"Procesando fila {i+1}")
-            cols = row.find_all("td")
-            if len(cols) < 5:
-                continue
+        ex = ThreadPoolExecutor(max_workers=8)
+        try:
+            # Filtro barato previo: un HEAD por candidato descarta entradas
+            # rotas o ZIPs gigantes (OOM en funciones de 256 MB) antes de
+            # gastar un GET de varios MB en ellas
+            head_map = {
+                ex.submit(session.head, url, allow_redirects=True, timeout=5): (artist, title, url)
+                for artist, title, url in candidates
+            }
+            viable = []
+            for fut in as_completed(head_map):
+                try:
+                    head = fut.result()
+                except requests.RequestException:
+                    continue
+                size = int(head.headers.get("Content-Length", "0") or 0)
+                if 200 <= head.status_code < 300 and size < MAX_ZIP_BYTES:
+                    viable.append(head_map[fut])
+            # Restauramos el orden original de la tabla de resultados
+            viable.sort(key=candidates.index)
+            logger.debug("HEAD filtró %d → %d candidatos", len(candidates), len(viable))
 
-            artist = cols[0].get_text(strip=True)
-            title  = cols[1].get_text(strip=True)
-            dl_link = cols[-1].find("a")
-            if not dl_link:
-                continue
+            # Reutilizamos el pool urllib3 que ya montó la sesión; la cookie
+            # autenticada viaja como header plano en cada GET
+            pool = session.get_adapter("https://usdb.eu").poolmanager
+            dl_headers = zip_headers(session)
 
-            download_url = urljoin("https://usdb.eu", dl_link["href"])
-            log(f"Descargando ZIP → {download_url}")
+            # Guardamos el ranking de cada candidato: las descargas terminan
+            # en cualquier orden y el frontend renderiza el array tal cual,
+            # así que al final reordenamos según la tabla de resultados
+            futures_map = {}
+            for rank, (artist, title, download_url) in enumerate(viable):
+                logger.debug("Descargando ZIP → %s", download_url)
+                fut = ex.submit(download_zip, pool, download_url, dl_headers)
+                futures_map[fut] = (rank, artist, title)
 
-            zip_resp = session.get(download_url, timeout=20)
-            if zip_resp.status_code != 200:
-                continue
+            for fut in as_completed(futures_map):
+                if len(results) >= 3:
+                    break
+                rank, artist, title = futures_map[fut]
+                try:
+                    zip_buf = fut.result()
+                except (requests.RequestException, Urllib3HTTPError):
+                    logger.debug("Descarga falló: %s - %s → skip", artist, title)
+                    continue
+                if zip_buf is None:
+                    continue
 
-            try:
-                with zipfile.ZipFile(BytesIO(zip_resp.content)) as z:
-                    txt_files = [f for f in z.namelist() if f.lower().endswith(".txt")]
-                    if not txt_files:
-                        continue
-                    txt_content = z.read(txt_files[0]).decode("utf-8", errors="replace")
-                    results.append({
-                        "artist": artist,
-                        "title": title,
-                        "txt": txt_content,
-                        "source": "USDB"
-                    })
-                    log(f"Éxito: {artist} - {title}")
-            except zipfile.BadZipFile:
-                log("ZIP corrupto → skip")
-                continue
+                try:
+                    with zipfile.ZipFile(zip_buf) as z:
+                        # Primer .txt sin materializar el namelist completo, y
+                        # decodificado en streaming sin copia intermedia de bytes
+                        info = next((i for i in z.infolist()
+                                     if i.filename.lower().endswith(".txt")), None)
+                        if info is None:
+                            continue
+                        with z.open(info) as fh:
+                            txt_content = io.TextIOWrapper(fh, encoding="utf-8",
+                                                           errors="replace").read()
+                        results.append((rank, {
+                            "artist": artist,
+                            "title": title,
+                            "txt": txt_content,
+                            "source": "USDB"
+                        }))
+                        logger.debug("Éxito: %s - %s", artist, title)
+                        # Cortamos acá mismo: si esperáramos a la próxima
+                        # vuelta de as_completed nos bloquearía hasta que
+                        # termine otra descarga en vuelo
+                        if len(results) >= 3:
+                            break
+                except zipfile.BadZipFile:
+                    logger.debug("ZIP corrupto → skip")
+                    continue
+                finally:
+                    zip_buf.close()
+        finally:
+            # Respondemos ya: cancelamos lo pendiente y NO esperamos a que
+            # terminen las descargas en vuelo (un `with` bloquearía acá
+            # hasta que el último ZIP sobrante baje completo)
+            ex.shutdown(wait=False, cancel_futures=True)
 
-            if len(results) >= 3:
-                break
+        # De orden-de-llegada al ranking original de la búsqueda
+        results = [song for _, song in sorted(results, key=lambda pair: pair[0])]
 
-        log(f"Resultado final: {len(results)} canciones")
+        logger.info("Resultado final: %d canciones", len(results))
+        body_out = json_dumps(results)
+        cache_put(key, body_out)
         return {
             "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(results, ensure_ascii=False)
+            "headers": {"Content-Type": "application/json", "X-Cache": "MISS"},
+            "body": body_out
         }
 
     except Exception as e:
-        log("EXCEPCIÓN NO CONTROLADA:")
-        log(traceback.format_exc())
+        logger.error("EXCEPCIÓN NO CONTROLADA:\n%s", traceback.format_exc())
         return {
             "statusCode": 500,
             "body": json.dumps({"error": str(e), "trace": traceback.format_exc()})